@@ -0,0 +1,98 @@
+import asyncio
+import os
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
+from langchain_core.tools import tool
+from langgraph.checkpoint.memory import MemorySaver
+
+import travel
+
+
+@tool
+async def echo(x: int) -> list:
+    """Echo x back."""
+    return [{"x": x}]
+
+
+class FakeLLM:
+    """Streams one canned AIMessageChunk per call instead of calling OpenAI."""
+    def __init__(self, responses):
+        self.responses = iter(responses)
+
+    async def astream(self, messages, **kwargs):
+        yield next(self.responses)
+
+
+def test_one_tool_round_keeps_each_message_once():
+    agent = travel.Agent(MemorySaver())
+    agent.tools = {"echo": echo}
+    agent.tools_llm = FakeLLM([
+        AIMessageChunk(content="", tool_call_chunks=[
+            {"name": "echo", "args": '{"x": 1}', "id": "call_1", "index": 0},
+        ]),
+        AIMessageChunk(content="done"),
+    ])
+    config = {"configurable": {"thread_id": "t1"}}
+
+    state = asyncio.run(agent.graph.ainvoke({"messages": [HumanMessage(content="hi")]}, config=config))
+
+    assert [type(m) for m in state["messages"]] == [HumanMessage, AIMessage, ToolMessage, AIMessage]
+    assert state["messages"][2].tool_call_id == "call_1"
+    assert state["messages"][2].content == '[{"x":1}]'
+    assert state["messages"][3].content == "done"
+    # the final turn has no tool calls, so no per-thread entry is left behind
+    assert agent._pending == {}
+
+
+class FailingLLM:
+    """Streams two tool calls, then fails before the message is complete."""
+    async def astream(self, messages, **kwargs):
+        yield AIMessageChunk(content="", tool_call_chunks=[
+            {"name": "echo", "args": '{"x": 1}', "id": "call_1", "index": 0},
+            {"name": "echo", "args": '{"x": 2}', "id": "call_2", "index": 1},
+        ])
+        raise RuntimeError("stream dropped")
+
+
+def test_failed_stream_cancels_started_tool_calls():
+    agent = travel.Agent(MemorySaver())
+    agent.tools = {"echo": echo}
+    agent.tools_llm = FailingLLM()
+    config = {"configurable": {"thread_id": "t2"}}
+
+    with pytest.raises(RuntimeError, match="stream dropped"):
+        asyncio.run(agent.graph.ainvoke({"messages": [HumanMessage(content="hi")]}, config=config))
+
+    assert agent._pending == {}
+
+
+def test_retry_budget_stops_identical_failing_calls():
+    calls = []
+
+    @tool
+    async def broken(x: int) -> str:
+        """Always fails."""
+        calls.append(x)
+        return "SerpAPI error"
+
+    def call(n):
+        return AIMessageChunk(content="", tool_call_chunks=[
+            {"name": "broken", "args": '{"x": 1}', "id": f"call_{n}", "index": 0},
+        ])
+
+    agent = travel.Agent(MemorySaver())
+    agent.tools = {"broken": broken}
+    agent.tools_llm = FakeLLM([call(n) for n in range(travel.MAX_ATTEMPTS + 1)] + [AIMessageChunk(content="done")])
+    config = {"configurable": {"thread_id": "t3"}}
+
+    state = asyncio.run(agent.graph.ainvoke({"messages": [HumanMessage(content="hi")]}, config=config))
+
+    tool_messages = [m for m in state["messages"] if isinstance(m, ToolMessage)]
+    assert len(calls) == travel.MAX_ATTEMPTS
+    assert [m.content for m in tool_messages[:-1]] == ["SerpAPI error"] * travel.MAX_ATTEMPTS
+    assert tool_messages[-1].content == f"No results after {travel.MAX_ATTEMPTS} attempts; do not retry."
+    assert agent._pending == {}
@@ -1,37 +1,99 @@
-import os
+import asyncio
 import datetime
+import hashlib
+import itertools
 import operator
 import os
+import queue
+import threading
+import time
 import uuid
 
-from typing import Annotated, TypedDict, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Annotated, AsyncIterator, Literal, TypedDict, Optional
 from dotenv import load_dotenv
-from langchain_core.messages import AnyMessage, HumanMessage, SystemMessage, ToolMessage
-from langchain_openai import ChatOpenAI
-from langgraph.checkpoint.memory import MemorySaver
+from langchain_core.runnables import RunnableConfig
+from langchain_core.messages import AnyMessage, HumanMessage, SystemMessage, ToolMessage, message_chunk_to_message
+import aiosqlite
+import zstandard
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph import END, StateGraph
-import serpapi
+import httpx
+import orjson
+from cachetools import TTLCache
 # Tool definitions
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from langchain_core.tools import tool
-import gradio as gr
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import os
 
 
 # Load environment variables from a .env file
-
-from dotenv import load_dotenv
 load_dotenv()
 
-CURRENT_YEAR = datetime.datetime.now().year
-
-TOOLS_SYSTEM_PROMPT = f"""You are a smart travel agency. Use the tools to look up information.
+# one keep-alive HTTP/2 client for all SerpAPI calls, so concurrent flight and
+# hotel searches share a single TLS connection instead of handshaking each time
+_SERP = httpx.AsyncClient(
+    base_url="https://serpapi.com",
+    http2=True,
+    timeout=15.0,
+    limits=httpx.Limits(max_keepalive_connections=8),
+)
+
+# SerpAPI results for the same search are stable for a while, so successful
+# responses are cached in-process (flights for 10 min, hotels for 30 min)
+_FLIGHTS_CACHE = TTLCache(maxsize=512, ttl=600)
+_HOTELS_CACHE = TTLCache(maxsize=512, ttl=1800)
+# searches SerpAPI found nothing for are remembered briefly so quick retries skip the network
+_FAILED_CACHE = TTLCache(maxsize=512, ttl=60)
+_CACHE_LOCK = threading.Lock()
+
+def _cache_get(cache, key):
+    with _CACHE_LOCK:
+        return cache.get(key)
+
+def _cache_put(cache, key, value):
+    with _CACHE_LOCK:
+        cache[key] = value
+
+# query keys SerpAPI always gets; any other key is dropped when unset/zero so
+# e.g. a one-way search doesn't send return_date=None
+_REQUIRED_QUERY_KEYS = {
+    'api_key', 'engine', 'hl', 'gl', 'currency',
+    'departure_id', 'arrival_id', 'outbound_date', 'adults',
+    'q', 'check_in_date', 'check_out_date',
+}
+
+def _drop_empty(query):
+    return {k: v for k, v in query.items() if k in _REQUIRED_QUERY_KEYS or v not in (None, 0, "")}
+
+def _is_no_results(error):
+    # e.g. "Google Hotels hasn't returned any results for this query."
+    return "returned any results" in error
+
+async def _serp_search(query):
+    """
+    Run a SerpAPI search and return the parsed body. SerpAPI reports failures
+    (bad key, quota, invalid params, no results) in its "error" field.
+    """
+    response = await _SERP.get("/search.json", params=_drop_empty(query))
+    try:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
+        # not a SerpAPI body (e.g. a gateway error page): report the HTTP status
+        response.raise_for_status()
+        raise
+
+# The system prompt is kept free of dynamic values (the current year is sent as
+# the first user message instead) so it forms a byte-stable prefix that OpenAI
+# can serve from its prompt cache across turns and days
+TOOLS_SYSTEM_PROMPT = """You are a smart travel agency. Use the tools to look up information.
 You are allowed to make multiple calls (either together or in sequence).
 Only look up information when you are sure of what you want.
-The current year is {CURRENT_YEAR}. If you don't get flights, try searching till you find them!
+If you don't get flights, try searching again with adjusted parameters, but stop once a tool tells you not to retry!
 If you need to look up some information before asking a follow up question, you are allowed to do that!
 In your output, include links to hotel websites and flight websites (if possible),
 the logo of the hotel and the logo of the airline company (if possible),
@@ -41,8 +103,18 @@ For example, for hotels:
     Total: $3,488
 """
 
+_SYSTEM_MSG = SystemMessage(content=TOOLS_SYSTEM_PROMPT)
+
+# every request shares the system prompt + tool schemas prefix, so route all of
+# them (across queries and days) to the same OpenAI prompt cache entry
+PROMPT_CACHE_KEY = "travel-agent-tools"
+
+class ToolInput(BaseModel):
+    """Base for the tool input models: immutable, ignores unknown keys, strips strings."""
+    model_config = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
 # define flight tool
-class FlightsInput(BaseModel):
+class FlightsInput(ToolInput):
     departure_airport:Optional[str] = Field(description="Departure airport code (IATA)")
     arrival_airport:Optional[str] = Field(description="Arrival airport code (IATA)")
     outbound_date:Optional[str] = Field(description="Outbound date (YYYY-MM-DD)")
@@ -52,23 +124,32 @@ class FlightsInput(BaseModel):
     infants_in_seat: Optional[int] = Field(0, description='Number of infants in seat (default 0)')
     infants_on_lap: Optional[int]   = Field(0, description='Number of infants on lap (default 0)')
 
-class FlightsInputSchema(BaseModel):
-    params:FlightsInput
-
-@tool(args_schema=FlightsInputSchema)
-def flights_finder(params:FlightsInput):
+@tool(args_schema=FlightsInput)
+async def flights_finder(**kwargs):
     """
     Find flights using the Google Flights engine (via SerpAPI).
     Returns:
         dict or str: Flight search results or error message.
     """
+    # kwargs were already validated against the args_schema by the tool
+    params = FlightsInput.model_construct(**kwargs)
+    key = (
+        (params.departure_airport or '').upper(), (params.arrival_airport or '').upper(),
+        params.outbound_date, params.return_date, params.adults, params.children,
+        params.infants_in_seat, params.infants_on_lap,
+    )
+    cached = _cache_get(_FLIGHTS_CACHE, key)
+    if cached is None:
+        cached = _cache_get(_FAILED_CACHE, ('flights', key))
+    if cached is not None:
+        return cached
     query = {
         'api_key': os.environ.get('SERPAPI_API_KEY'),
         'engine': 'google_flights',
         'hl': 'en',
         'gl': 'us',
-        'departure_id': params.departure_airport,
-        'arrival_id': params.arrival_airport,
+        'departure_id': key[0],
+        'arrival_id': key[1],
         'outbound_date': params.outbound_date,
         'return_date': params.return_date,
         'currency': 'USD',
@@ -79,33 +160,58 @@ def flights_finder(params:FlightsInput):
         'children': params.children
     }
     try:
-        search = serpapi.search(query)
-        return search.data['best_flights']
+        data = await _serp_search(query)
     except Exception as e:
+        # transport errors (timeouts, 429/5xx) are transient: don't cache them
         return str(e)
+    if 'error' in data:
+        if _is_no_results(data['error']):
+            _cache_put(_FAILED_CACHE, ('flights', key), data['error'])
+        return data['error']
+    flights = data.get('best_flights', [])
+    if flights:
+        _cache_put(_FLIGHTS_CACHE, key, flights)
+    else:
+        _cache_put(_FAILED_CACHE, ('flights', key), flights)
+    return flights
 
 
 # define hotel tool
-class HotelsInput(BaseModel):
+SORT_BY_RATING = '8'
+
+class HotelsBaseInput(ToolInput):
     q: str = Field(description='Location for hotels (e.g., "New York")')
     check_in_date: str  = Field(description='Check-in date (YYYY-MM-DD)')
     check_out_date: str = Field(description='Check-out date (YYYY-MM-DD)')
-    sort_by: Optional[str] = Field(8, description='Sorting parameter (default=8 for rating)')
+    sort_by: Optional[str] = Field(SORT_BY_RATING, description='Sorting parameter (default=8 for rating)')
     adults: Optional[int]   = Field(1, description='Number of adults (default 1)')
     children: Optional[int] = Field(0, description='Number of children (default 0)')
     rooms: Optional[int]    = Field(1, description='Number of rooms (default 1)')
-    hotel_class: Optional[str] = Field(None, description='Filter by hotel class (e.g., "3" or "4")')
 
-class HotelsInputSchema(BaseModel):
-    params:HotelsInput
+class HotelsInput(HotelsBaseInput):
+    hotel_class: Optional[str] = Field(None, description='Filter by hotel class (e.g., "3" or "4")')
 
-@tool(args_schema=HotelsInputSchema)
-def hotels_finder(params:HotelsInput):
+@tool(args_schema=HotelsInput)
+async def hotels_finder(**kwargs):
     """
     Find hotels using the Google Hotels engine (via SerpAPI).
     Returns:
         list or str: Up to 5 hotel property dicts or error message.
     """
+    # kwargs were already validated against the args_schema by the tool
+    params = HotelsInput.model_construct(**kwargs)
+    return await _search_hotels(params)
+
+async def _search_hotels(params:HotelsInput):
+    key = (
+        params.q.strip().lower(), params.check_in_date, params.check_out_date, params.sort_by,
+        params.adults, params.children, params.rooms, params.hotel_class,
+    )
+    cached = _cache_get(_HOTELS_CACHE, key)
+    if cached is None:
+        cached = _cache_get(_FAILED_CACHE, ('hotels', key))
+    if cached is not None:
+        return cached
     query = {
         'api_key': os.environ.get('SERPAPI_API_KEY'),
         'engine': 'google_hotels',
@@ -122,73 +228,314 @@ def hotels_finder(params:HotelsInput):
         'hotel_class': params.hotel_class
     }
     try:
-        search = serpapi.search(query)
-        data = search.data
-        return data['properties'][:5]
+        data = await _serp_search(query)
     except Exception as e:
+        # transport errors (timeouts, 429/5xx) are transient: don't cache them
         return str(e)
+    if 'error' in data:
+        if _is_no_results(data['error']):
+            _cache_put(_FAILED_CACHE, ('hotels', key), data['error'])
+        return data['error']
+    hotels = data.get('properties', [])[:5]
+    if hotels:
+        _cache_put(_HOTELS_CACHE, key, hotels)
+    else:
+        _cache_put(_FAILED_CACHE, ('hotels', key), hotels)
+    return hotels
+
+
+# define batch hotel tool
+class HotelsBatchInput(HotelsBaseInput):
+    hotel_classes: list[str] = Field(description='Hotel classes to search (e.g., ["3", "4"])')
+
+@tool(args_schema=HotelsBatchInput)
+async def hotels_finder_batch(**kwargs):
+    """
+    Find hotels of several hotel classes at once using the Google Hotels engine (via SerpAPI).
+    Prefer this over hotels_finder whenever more than one hotel class is wanted
+    (e.g. "3 or 4 star hotels"): the classes are searched in parallel in a single call.
+    Returns:
+        list or str: Up to 5 hotel property dicts (best rated first when sorting by rating) or error message.
+    """
+    # kwargs were already validated against the args_schema by the tool
+    params = HotelsBatchInput.model_construct(**kwargs)
+    base = params.model_dump(exclude={'hotel_classes'})
+    results = await asyncio.gather(
+        *(_search_hotels(HotelsInput(**base, hotel_class=c)) for c in params.hotel_classes)
+    )
+    # interleave the classes so each keeps SerpAPI's own ordering
+    found = [r for r in results if not isinstance(r, str)]
+    hotels = {}
+    for props in itertools.zip_longest(*found):
+        for prop in props:
+            if prop is not None:
+                hotels.setdefault(prop.get('name'), prop)
+    if not hotels:
+        # every search failed, surface the first error
+        return next((r for r in results if isinstance(r, str)), [])
+    merged = list(hotels.values())
+    if params.sort_by == SORT_BY_RATING:
+        merged.sort(key=lambda p: p.get('overall_rating') or 0, reverse=True)
+    return merged[:5]
+
+# SerpAPI fields that only cost prompt tokens: the LLM never needs them
+_PRUNED_KEYS = {
+    'serpapi_pagination', 'search_metadata', 'search_parameters',
+    'serpapi_property_details_link', 'original_image',
+}
+
+def _prune(data):
+    if isinstance(data, dict):
+        return {k: _prune(v) for k, v in data.items() if k not in _PRUNED_KEYS}
+    if isinstance(data, list):
+        return [_prune(v) for v in data]
+    return data
+
+def _serialize_tool_output(output):
+    # compact JSON is far fewer tokens than the repr of a list of dicts
+    return orjson.dumps(_prune(output), default=str).decode()
 
 # define tool
-TOOLS = [flights_finder,hotels_finder]
+TOOLS = [flights_finder,hotels_finder,hotels_finder_batch]
 
 # define Agent State
 class AgentState(TypedDict):
     messages:Annotated[list[AnyMessage],operator.add]
+    # failed calls per "tool_name:args_hash", to bound the LLM's retries
+    attempts:dict
+
+MAX_ATTEMPTS = 3
+
+def _attempt_key(t):
+    args = orjson.dumps(t["args"], option=orjson.OPT_SORT_KEYS, default=str)
+    return f'{t["name"]}:{hashlib.sha1(args).hexdigest()}'
+
+# number of most recent messages sent to the LLM on top of the user's opening messages
+CONTEXT_WINDOW = 20
+
+def _context_window(messages, k=CONTEXT_WINDOW):
+    """
+    Keep the opening HumanMessages (the user's query) plus the last k messages,
+    never starting the tail on a ToolMessage whose tool call was cut off.
+    """
+    head = 0
+    while head < len(messages) and isinstance(messages[head], HumanMessage):
+        head += 1
+    start = max(head, len(messages) - k)
+    while start < len(messages) and isinstance(messages[start], ToolMessage):
+        start += 1
+    return messages[:head] + messages[start:]
+
+# define checkpointer
+CHECKPOINT_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), "checkpoints.db")
+
+class ZstdSerializer:
+    """
+    Checkpoint serializer that zstd-compresses the output of another serializer
+    (JsonPlusSerializer by default). Uncompressed rows are still readable.
+    """
+    PREFIX = "zstd+"
+
+    def __init__(self, serde=None, level=3):
+        self.serde = serde or JsonPlusSerializer()
+        self.level = level
+
+    def dumps(self, obj):
+        return self.serde.dumps(obj)
+
+    def loads(self, data):
+        return self.serde.loads(data)
+
+    def dumps_typed(self, obj):
+        type_, data = self.serde.dumps_typed(obj)
+        # compressor objects aren't thread-safe, so make one per call
+        return self.PREFIX + type_, zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def loads_typed(self, data):
+        type_, payload = data
+        if type_.startswith(self.PREFIX):
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+            return self.serde.loads_typed((type_[len(self.PREFIX):], payload))
+        return self.serde.loads_typed(data)
 
 # build agent
 class Agent():
-    def __init__(self):
+    def __init__(self, checkpointer):
+        # imported here so loading the module (e.g. for the tools) stays cheap
+        from langchain_openai import ChatOpenAI
+
         self.tools = {t.name: t for t in TOOLS}
-        self.tools_llm = ChatOpenAI(model="gpt-4o").bind_tools(TOOLS)
+        self.tools_llm = ChatOpenAI(model="gpt-4o", streaming=True).bind_tools(TOOLS)
+        # tool calls started while the LLM was still decoding: thread_id -> {tool_call_id: task}
+        self._pending = {}
         builder = StateGraph(AgentState)
         builder.add_node("call_tools_llm",self.call_tools_llm)
-        builder.add_node("invoke_tools",self.invoke_tools)
-        builder.add_node("email_sender",self.email_sender)
+        builder.add_node("invoke_tools",self.ainvoke_tools)
         builder.set_entry_point("call_tools_llm")
-        builder.add_conditional_edges(
-            "call_tools_llm",
-            Agent.conditions,
-            {"email_sender":"email_sender","more_tools":"invoke_tools"}
-        )
+        builder.add_conditional_edges("call_tools_llm", Agent.conditions)
         builder.add_edge("invoke_tools","call_tools_llm")
-        builder.add_edge("email_sender",END)
-        memory = MemorySaver()
-        self.graph = builder.compile(checkpointer=memory,interrupt_before=['email_sender'])
+        self.graph = builder.compile(checkpointer=checkpointer)
 
     @staticmethod
-    def conditions(state: AgentState):
-        result = state["messages"][-1]
-        if len(result.tool_calls) == 0:
-            return "email_sender"
-        else:
-            return "more_tools"
+    def conditions(state: AgentState) -> Literal["invoke_tools", "__end__"]:
+        # return the next node's name directly, no path map lookup
+        return "invoke_tools" if state["messages"][-1].tool_calls else END
         
-    def call_tools_llm(self,state: AgentState):
-        messages = [SystemMessage(content=TOOLS_SYSTEM_PROMPT)] + state["messages"]
-        messages = self.tools_llm.invoke(messages)
+    async def call_tools_llm(self,state: AgentState, config: RunnableConfig):
+        thread_id = config["configurable"]["thread_id"]
+        attempts = state.get("attempts") or {}
+        full = None
+        try:
+            async for chunk in self.tools_llm.astream(
+                [_SYSTEM_MSG, *_context_window(state["messages"])],
+                # pass the callbacks on explicitly: contextvars don't carry them
+                # into async generators before Python 3.11
+                config=config,
+                extra_body={"prompt_cache_key": PROMPT_CACHE_KEY},
+            ):
+                full = chunk if full is None else full + chunk
+                # a tool call is complete once the model has moved on to the next one:
+                # start it now instead of waiting for the rest of the message
+                for t in full.tool_calls[:-1]:
+                    self._dispatch(thread_id, t, attempts)
+            if full is None:
+                raise ValueError("The LLM stream ended without producing a message")
+        except BaseException:
+            # the run failed or was cancelled: nothing will await the started calls
+            self.cancel_pending(thread_id)
+            raise
+        messages = message_chunk_to_message(full)
+        for t in messages.tool_calls:
+            self._dispatch(thread_id, t, attempts)
         return {"messages":[messages]}
-    
-    def invoke_tools(self, state: AgentState):
+
+    def _dispatch(self, thread_id, t, attempts):
+        pending = self._pending.get(thread_id, {})
+        if t["id"] not in pending and attempts.get(_attempt_key(t), 0) < MAX_ATTEMPTS:
+            # the per-thread entry only exists while it holds started calls
+            self._pending.setdefault(thread_id, pending)[t["id"]] = asyncio.create_task(self._ainvoke_tool(t))
+
+    def cancel_pending(self, thread_id):
+        """
+        Cancel and forget the tool calls started for a run that won't collect them.
+        """
+        for task in self._pending.pop(thread_id, {}).values():
+            task.cancel()
+
+    async def ainvoke_tools(self, state: AgentState, config: RunnableConfig):
         message = state["messages"][-1]
+        pending = self._pending.pop(config["configurable"]["thread_id"], {})
+        attempts = dict(state.get("attempts") or {})
+        keys = [_attempt_key(t) for t in message.tool_calls]
+        exhausted = {key for key in keys if attempts.get(key, 0) >= MAX_ATTEMPTS}
+
+        async def run(t, key):
+            if key in exhausted:
+                return f"No results after {MAX_ATTEMPTS} attempts; do not retry."
+            return await (pending.pop(t["id"], None) or self._ainvoke_tool(t))
+
+        # await the tool calls started during decoding (running any that weren't);
+        # gather keeps results in tool_call order
+        try:
+            outputs = await asyncio.gather(
+                *(run(t, key) for t, key in zip(message.tool_calls, keys)),
+                return_exceptions=True,
+            )
+        finally:
+            for task in pending.values():
+                task.cancel()
         results = []
-        for t in message.tool_calls:
-            if t["name"] not in self.tools:
-                results.append(
-                    ToolMessage(tool_call_id=t['id'], name=t['name'], content="Bad tool name")
-                )
+        for t, key, output in zip(message.tool_calls, keys, outputs):
+            if isinstance(output, Exception):
+                content = f"Error: {output}"
+            elif isinstance(output, str):
+                content = output
             else:
-                messages = self.tools[t["name"]].invoke(t["args"])
-                results.append(
-                    ToolMessage(tool_call_id = t["id"],name=t["name"],content=str(messages))
-                )
-        return {"messages":results}
-    def email_sender(self, state: AgentState):
-        return {'messages': []}
+                content = _serialize_tool_output(output)
+            # errors and empty results count against the retry budget
+            if key not in exhausted and (isinstance(output, (Exception, str)) or not output):
+                attempts[key] = attempts.get(key, 0) + 1
+            results.append(ToolMessage(tool_call_id=t["id"], name=t["name"], content=content))
+        return {"messages":results, "attempts":attempts}
+
+    async def _ainvoke_tool(self, t):
+        if t["name"] not in self.tools:
+            return "Bad tool name"
+        return await self.tools[t["name"]].ainvoke(t["args"])
 
 
 
 # via Gmail to send
 
+class SmtpPool:
+    """
+    Keeps logged-in SMTP connections per (sender, app_password) so repeated
+    emails skip the TCP + STARTTLS + AUTH handshake.
+    """
+    def __init__(self, host="smtp.gmail.com", port=587, maxsize=5, max_messages=100):
+        self.host = host
+        self.port = port
+        self.maxsize = maxsize
+        # Gmail caps the number of messages per SMTP session
+        self.max_messages = max_messages
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def _pool(self, key):
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = queue.Queue(maxsize=self.maxsize)
+            return self._pools[key]
+
+    def _connect(self, sender, app_password):
+        server = smtplib.SMTP(self.host, self.port)
+        try:
+            server.starttls()
+            server.login(sender, app_password)
+        except Exception:
+            # e.g. a bad app password: don't leak the half-open connection
+            self._close(server)
+            raise
+        server.messages_sent = 0
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def get(self, sender, app_password):
+        pool = self._pool((sender, app_password))
+        while True:
+            try:
+                server = pool.get_nowait()
+            except queue.Empty:
+                return self._connect(sender, app_password)
+            if server.messages_sent >= self.max_messages:
+                self._close(server)
+                continue
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPServerDisconnected, OSError):
+                pass
+            self._close(server)
+
+    def put(self, sender, app_password, server):
+        try:
+            self._pool((sender, app_password)).put_nowait(server)
+        except queue.Full:
+            self._close(server)
+
+SMTP_POOL = SmtpPool()
+
+# emails are sent in the background; the UI polls the futures by job id. Jobs
+# expire so ones nobody collects (tab closed, job replaced by a new click) don't pile up
+_MAIL_POOL = ThreadPoolExecutor(max_workers=4)
+_MAIL_JOBS = TTLCache(maxsize=256, ttl=600)
+
 def send_html_email(travel_html: str, sender: str, receiver: str, subject: str) -> str:
     try:
         msg = MIMEMultipart("alternative")
@@ -199,10 +546,19 @@ def send_html_email(travel_html: str, sender: str, receiver: str, subject: str)
         html_part = MIMEText(travel_html, "html")
         msg.attach(html_part)
 
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(sender, os.environ["GMAIL_APP_PASSWORD"])
+        app_password = os.environ["GMAIL_APP_PASSWORD"]
+        server = SMTP_POOL.get(sender, app_password)
+        try:
             server.sendmail(sender, receiver, msg.as_string())
+            server.messages_sent += 1
+        except Exception:
+            # don't hand a connection in an unknown state back to the pool
+            SmtpPool._close(server)
+            server = None
+            raise
+        finally:
+            if server is not None:
+                SMTP_POOL.put(sender, app_password, server)
 
         return "Email sent successfully via Gmail SMTP!"
 
@@ -210,60 +566,153 @@ def send_html_email(travel_html: str, sender: str, receiver: str, subject: str)
         return f"Error sending email: {e}"
 
 # create agent
-agent = Agent()
+_agent = None
+_agent_loop = None
+_checkpoint_conn = None
+
+async def get_agent() -> Agent:
+    """
+    Create the agent on first use: the async SQLite checkpointer has to be
+    built inside the running event loop.
+    """
+    global _agent, _agent_loop, _checkpoint_conn
+    if _agent is None:
+        _agent_loop = asyncio.get_running_loop()
+        _checkpoint_conn = aiosqlite.connect(CHECKPOINT_DB)
+        _agent = Agent(AsyncSqliteSaver(_checkpoint_conn, serde=ZstdSerializer()))
+    return _agent
+
+async def close_agent():
+    """
+    Close the checkpoint database and the SerpAPI client. aiosqlite's worker
+    thread is not a daemon, so the interpreter can't exit while the connection is open.
+    """
+    global _agent, _agent_loop, _checkpoint_conn
+    if _checkpoint_conn is not None:
+        await _checkpoint_conn.close()
+    await _SERP.aclose()
+    _agent = _agent_loop = _checkpoint_conn = None
+
+def shutdown():
+    """
+    Run close_agent() on the event loop the agent was used on, since the pooled
+    connections belong to it; fall back to a fresh loop if it never ran.
+    """
+    if _agent_loop is not None and _agent_loop.is_running():
+        asyncio.run_coroutine_threadsafe(close_agent(), _agent_loop).result(timeout=10)
+    else:
+        asyncio.run(close_agent())
 
 # Gradio callables 
-def process_query_gradio(user_query: str) -> str:
+async def process_query_gradio(user_query: str) -> AsyncIterator[str]:
     """
-    Run the agent on the given travel query string, return the final text output.
+    Run the agent on the given travel query string, yielding the final text output
+    as it is streamed from the LLM.
     """
     thread_id = str(uuid.uuid4())
-    # Create a single HumanMessage containing the entire query
-    message = [HumanMessage(content=user_query)]
+    # Create a single HumanMessage containing the entire query, preceded by the
+    # current year (kept out of the system prompt so that stays cacheable)
+    message = [
+        HumanMessage(content=f"The current year is {datetime.datetime.now().year}."),
+        HumanMessage(content=user_query),
+    ]
     config = {'configurable': {'thread_id': thread_id}}
 
-    state = agent.graph.invoke({"messages":message}, config=config)
-    return state["messages"][-1].content
-
-
-def process_email_gradio(travel_info: str, sender: str, receiver: str, subject: str) -> str:
+    agent = await get_agent()
+    text = ""
+    try:
+        async for ev in agent.graph.astream_events({"messages":message}, config=config, version="v2"):
+            if ev["event"] == "on_chat_model_start":
+                # only the last LLM turn holds the answer, earlier ones lead to tool calls
+                text = ""
+            elif ev["event"] == "on_chat_model_stream" and ev["data"]["chunk"].content:
+                text += ev["data"]["chunk"].content
+                yield text
+    finally:
+        # e.g. the client disconnected between the LLM and tools nodes
+        agent.cancel_pending(thread_id)
+        # every query runs on its own thread and nothing resumes it, so don't
+        # keep its checkpoints around
+        await agent.graph.checkpointer.adelete_thread(thread_id)
+
+
+def process_email_gradio(travel_info: str, sender: str, receiver: str, subject: str):
     """
     Take the travel_info (HTML or plain text from the agent),
-    plus sender/receiver/subject, and send via SendGrid.
+    plus sender/receiver/subject, and queue it for sending via Gmail SMTP.
+    Returns the status message and the job id to poll (None if nothing was queued).
     """
     if not sender or not receiver or not subject or not travel_info:
-        return "Error: All fields are required."
-    return send_html_email(travel_info, sender, receiver, subject)
-
-
-# ===== 6) Build the Gradio Interface =====
-with gr.Blocks() as demo:
-    gr.Markdown("# AI Travel Agent")
-    gr.Markdown("Enter a travel query below (e.g. “Flights from New York to London June 10–15, and 4-star hotels”).")
-
-    # Textbox to accept the user’s travel query
-    query_input = gr.Textbox(lines=3, placeholder="Type your travel query here…", label="Travel Query")
-    query_button = gr.Button("Get Travel Information")
-    travel_output = gr.Markdown("", label="Travel Info (Agent’s Response)")
-
-    # When clicked, run process_query_gradio and show result in travel_output
-    query_button.click(fn=process_query_gradio, inputs=query_input, outputs=travel_output)
-
-    gr.Markdown("---\n## Send the Above Info via Email")
-    gr.Markdown("Enter sender, receiver, and subject. The email body will be exactly what the agent printed above.")
-    sender_input   = gr.Textbox(label="Sender Email")
-    receiver_input = gr.Textbox(label="Receiver Email")
-    subject_input  = gr.Textbox(label="Subject", value="Travel Information")
-    email_button   = gr.Button("Send Email")
-    email_status   = gr.Textbox(label="Email Status / Error")
-
-    # When clicked, run process_email_gradio using travel_output plus the three email fields
-    email_button.click(
-        fn=process_email_gradio,
-        inputs=[travel_output, sender_input, receiver_input, subject_input],
-        outputs=email_status
-    )
-# Launch Gradio app
-if __name__ == "__main__":
-    demo.launch(server_name="0.0.0.0", share=True)
+        return "Error: All fields are required.", None
+    job_id = uuid.uuid4().hex[:8]
+    _cache_put(_MAIL_JOBS, job_id, _MAIL_POOL.submit(send_html_email, travel_info, sender, receiver, subject))
+    return f"Queued as {job_id}", job_id
+
+
+def process_email_status_gradio(job_id: Optional[str], status: str) -> tuple[str, bool]:
+    """
+    Report the outcome of a queued email, leaving the current status untouched
+    when there is no pending job. Also returns whether the job is still pending.
+    """
+    future = _cache_get(_MAIL_JOBS, job_id) if job_id else None
+    if future is None:
+        return status, False
+    if not future.done():
+        return f"Queued as {job_id}, sending…", True
+    with _CACHE_LOCK:
+        _MAIL_JOBS.pop(job_id, None)
+    return future.result(), False
+
 
+# ===== 6) Build the Gradio Interface and launch it =====
+if __name__ == "__main__":
+    # gradio is only needed to serve the UI, so it isn't imported with the module
+    import gradio as gr
+
+    with gr.Blocks() as demo:
+        gr.Markdown("# AI Travel Agent")
+        gr.Markdown("Enter a travel query below (e.g. “Flights from New York to London June 10–15, and 4-star hotels”).")
+
+        # Textbox to accept the user’s travel query
+        query_input = gr.Textbox(lines=3, placeholder="Type your travel query here…", label="Travel Query")
+        query_button = gr.Button("Get Travel Information")
+        travel_output = gr.Markdown("", label="Travel Info (Agent’s Response)")
+
+        # When clicked, run process_query_gradio and show result in travel_output
+        query_button.click(fn=process_query_gradio, inputs=query_input, outputs=travel_output, queue=True)
+
+        gr.Markdown("---\n## Send the Above Info via Email")
+        gr.Markdown("Enter sender, receiver, and subject. The email body will be exactly what the agent printed above.")
+        sender_input   = gr.Textbox(label="Sender Email")
+        receiver_input = gr.Textbox(label="Receiver Email")
+        subject_input  = gr.Textbox(label="Subject", value="Travel Information")
+        email_button   = gr.Button("Send Email")
+        email_status   = gr.Textbox(label="Email Status / Error")
+        email_job      = gr.State(None)
+        # only polls while an email is queued
+        email_timer    = gr.Timer(2, active=False)
+
+        def poll_email(job_id, status):
+            status, pending = process_email_status_gradio(job_id, status)
+            return status, gr.Timer(active=pending)
+
+        # When clicked, queue process_email_gradio using travel_output plus the three email fields
+        email_button.click(
+            fn=process_email_gradio,
+            inputs=[travel_output, sender_input, receiver_input, subject_input],
+            outputs=[email_status, email_job]
+        ).then(fn=lambda job_id: gr.Timer(active=job_id is not None), inputs=email_job, outputs=email_timer)
+        # Poll the queued email and show its result once sent
+        email_timer.tick(fn=poll_email, inputs=[email_job, email_status], outputs=[email_status, email_timer])
+
+    # don't let launch() block: its Ctrl-C handler stops the server (and with it
+    # the event loop the agent's connections live on) before we could close them
+    demo.launch(server_name="0.0.0.0", share=True, prevent_thread_lock=True)
+    try:
+        while True:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown()
+        demo.close()